@@ -46,15 +46,17 @@ class ShiftEyeTrackingData(mdp.Node):
 
         
     def _execute(self, data):
-        slope_x = self.shift_x / (self.t1-self.t0)
-        slope_y = self.shift_y / (self.t1-self.t0)
-        ts = data[:,T]
-        where = S.where(ts > self.t0)
         dt_max = self.t1 - self.t0
+        slope_x = self.shift_x / dt_max
+        slope_y = self.shift_y / dt_max
+        # the clamped time offset is the same for both axes; samples before
+        # t0 get an offset of 0 and hence no shift, so no mask is needed
+        dt = data[:,T] - self.t0
+        S.clip(dt, 0, dt_max, dt)
         if self.shift_x != 0:
-            data[where,X] += S.minimum(data[where,T]-self.t0, dt_max) * slope_x
+            data[:,X] += dt * slope_x
         if self.shift_y != 0:
-            data[where,Y] += S.minimum(data[where,T]-self.t0, dt_max) * slope_y
+            data[:,Y] += dt * slope_y
         return data
     
     def __str__(self):
@@ -76,11 +78,11 @@ class JerkEyeTrackingData(mdp.Node):
     def is_trainable(self): return False    
         
     def _execute(self, data):
-        where = S.where(data[:,T] >= self.jerk_at)
+        mask = data[:,T] >= self.jerk_at
         if self.jerk_x != 0:
-            data[where,X] += self.jerk_x
+            data[mask,X] += self.jerk_x
         if self.jerk_y != 0:
-            data[where,Y] += self.jerk_y
+            data[mask,Y] += self.jerk_y
         return data
 
     def __str__(self):
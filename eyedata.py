@@ -24,14 +24,156 @@ The returned values from the datasource are [t,x,y], each.
 __version__ = 1.0
 
 import datasource as DS
-import scipy as S
-import mdp
+import numpy as np
 import logging
 import os
+import tempfile
+import zipfile
+try:
+    import pandas
+except ImportError:
+    pandas = None
 
 # constants for the columns in the samples of a EyeTrackerDataSource
 T, X, Y = 0, 1, 2
 
+# np.loadtxt is implemented in C since NumPy 1.23 and is faster than pandas
+# from then on; before, it is a Python loop and pandas' C parser pays off
+_use_pandas = (pandas is not None and 
+               tuple(int(v) for v in np.__version__.split('.')[:2]) < (1, 23))
+
+
+def _read_csv(filename, delimiter, skiprows, dtype):
+    '''Parse a CSV file into a structured array with the given dtype.
+    
+    Uses np.loadtxt, or the C parser of pandas on NumPy versions where
+    loadtxt is still written in Python. The pandas path follows loadtxt's
+    handling of comments, 'nan' values, whitespace and out-of-range ints.'''
+    if not _use_pandas:
+        return np.loadtxt(filename, 
+                          delimiter=delimiter, 
+                          skiprows=skiprows,
+                          unpack=False,
+                          ndmin=1,
+                          dtype=dtype)
+    # int columns are read as int64 and range-checked below, because a cast
+    # to int32 would silently wrap values that loadtxt rejects
+    types = {}
+    for name, typ in dtype:
+        kind = np.dtype(typ).kind
+        types[name] = str if kind in 'SU' else np.int64 if kind == 'i' else typ
+    df = pandas.read_csv(filename, 
+                         sep=delimiter, 
+                         skiprows=skiprows, 
+                         header=None,
+                         names=[name for name, _ in dtype],
+                         dtype=types,
+                         comment='#',
+                         keep_default_na=False,
+                         na_values=['nan', 'NaN'])
+    temp = np.empty(len(df), dtype=dtype)
+    for name in temp.dtype.names:
+        values = df[name].values
+        if temp.dtype[name].kind == 'i' and len(values) > 0:
+            info = np.iinfo(temp.dtype[name])
+            if values.min() < info.min or values.max() > info.max:
+                raise ValueError('%s out of range for %s in %s' % (name, temp.dtype[name], filename))
+        temp[name] = values
+    return temp
+
+
+def _sort_rows(temp):
+    '''Sort the parsed rows by (trial, person, eye) and return a dict with the
+    sorted keys 'trial', 'person' and 'eye' and the matching (N,3) 'samples'.
+    If the table has image filenames, 'img_filename' holds the filename of
+    the first row in the file of each trial/person, in sorted order.'''
+    # lexsort is stable, so each group stays in file order. Only the fields
+    # needed here are permuted; the image filenames (40 bytes per row) stay in
+    # file order and are looked up once per trial/person.
+    order = np.lexsort((temp['eye'], temp['person'], temp['trail']))
+    rows = dict(trial=temp['trail'][order], 
+                person=temp['person'][order], 
+                eye=temp['eye'][order])
+    # All samples go into one column-major table, so that the t, x and y
+    # columns of every row range are contiguous.
+    samples = np.empty((temp.size, 3), dtype=np.float32, order='F')
+    samples[:,T] = temp['t'][order]
+    samples[:,X] = temp['x'][order]
+    samples[:,Y] = temp['y'][order]
+    rows['samples'] = samples
+    if 'img_filename' in temp.dtype.names and temp.size == 0:
+        rows['img_filename'] = temp['img_filename'][:0]
+    elif 'img_filename' in temp.dtype.names:
+        trial, person = rows['trial'], rows['person']
+        new_tp = (trial[1:] != trial[:-1]) | (person[1:] != person[:-1])
+        starts = np.r_[0, np.flatnonzero(new_tp) + 1]
+        rows['img_filename'] = temp['img_filename'][np.minimum.reduceat(order, starts)]
+    return rows
+
+
+def _load_cache(filename, delimiter, skiprows, with_images):
+    '''Return the sorted rows cached by _save_cache for the CSV file, or None
+    if there is no cache or it is outdated.'''
+    cache_filename = filename + '.cache.npz'
+    if not os.path.exists(cache_filename):
+        return None
+    try:
+        cache = np.load(cache_filename, allow_pickle=False)
+        try:
+            if ('samples' not in cache.files or
+                cache['mtime'] != os.path.getmtime(filename) or
+                cache['delimiter'] != delimiter or
+                cache['skiprows'] != skiprows or
+                ('img_filename' in cache.files) != with_images):
+                return None
+            names = ['trial', 'person', 'eye', 'samples']
+            if with_images:
+                names.append('img_filename')
+            return dict((name, cache[name]) for name in names)
+        finally:
+            cache.close()
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        logging.getLogger('FixationData').warning('Ignoring unreadable cache %s', cache_filename)
+        return None
+
+
+def _save_cache(filename, delimiter, skiprows, rows):
+    '''Store the sorted rows of the CSV file next to it, tagged with the
+    modification time of the CSV file.
+    
+    The cache is written to a temporary file that is then renamed, so that
+    an interrupted or concurrent writer never leaves a partial cache behind.'''
+    cache_filename = filename + '.cache.npz'
+    tmp_filename = None
+    try:
+        fd, tmp_filename = tempfile.mkstemp(prefix=os.path.basename(cache_filename) + '.',
+                                            suffix='.tmp',
+                                            dir=os.path.dirname(cache_filename))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, 
+                     mtime=os.path.getmtime(filename),
+                     delimiter=delimiter,
+                     skiprows=skiprows,
+                     **rows)
+        # mkstemp creates the file readable by its owner only; give the cache
+        # the permissions a normally created file would get
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filename, 0o666 & ~umask)
+        if hasattr(os, 'replace'):
+            os.replace(tmp_filename, cache_filename)
+        else:
+            # Python 2: os.rename does not overwrite an existing file on Windows
+            if os.name == 'nt' and os.path.exists(cache_filename):
+                os.remove(cache_filename)
+            os.rename(tmp_filename, cache_filename)
+        tmp_filename = None
+    except (IOError, OSError):
+        logging.getLogger('FixationData').warning('Could not write cache %s', cache_filename)
+    finally:
+        if tmp_filename is not None and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
 
 class FixationData(object):
     ''''Base class for fixation data for several trials over several persons.'''
@@ -59,71 +201,70 @@ class FixationDataFromCSV(FixationData):
        trail, person, eye,               time,  x,    y 
        int,   int,    'L' or 'R' or 'X',  float, float, float
     
+    The parsed and sorted rows are cached in <filename>.cache.npz (unless
+    use_cache is False) and reused as long as the CSV file is not modified.
+    
     @note:
         The eye 'X' does not denote a fixation but the ground truth information
         of the true object location to look at for that trial/person. At least
         this is our interpretation for one of our data sets.
     '''
     def __init__(self, filename="fixation_data_pbp.csv", delimiter=",", skiprows=1,
-                 ranges=[[-100,1200],[600, -100]], image_dir=None, **kws):
+                 ranges=[[-100,1200],[600, -100]], image_dir=None, use_cache=True, **kws):
         if not os.path.isabs(filename):
             filename = os.path.dirname(os.path.abspath(__file__))+os.sep+filename
         super(FixationDataFromCSV, self).__init__(**kws)
         log = logging.getLogger('FixationData')
         log.info('Loading %s ...', filename)
         
+        dtype = [('trail',np.int32),
+                 ('person',np.int32)]
         if image_dir is not None:
             self.images_dir = os.path.dirname(os.path.abspath(__file__)) + os.sep + image_dir + os.sep
-            
-            # manually unpack for numpy 1.5 compatibility
-            temp = S.loadtxt(filename, 
-                             delimiter=delimiter, 
-                             skiprows=skiprows,
-                             unpack=False,
-                             dtype=[ ('trail',S.int32),
-                                     ('person',S.int32),
-                                     ('img_filename','S40'),
-                                     ('eye','S1'), #string of len 1
-                                     ('t',S.float32),
-                                     ('x',S.float32),
-                                     ('y',S.float32)])
-            trial, person, img_filename, eye, t, x, y = (temp[n] for n in temp.dtype.names)
-            log.info('Found %i entires', trial.size)
-            #self.trials['all'] = {} # special dict for all trials
+            dtype.append(('img_filename','S40'))
+        dtype += [('eye','S1'), #string of len 1
+                  ('t',np.float32),
+                  ('x',np.float32),
+                  ('y',np.float32)]
+        rows = None
+        if use_cache:
+            rows = _load_cache(filename, delimiter, skiprows, image_dir is not None)
+        if rows is None:
+            rows = _sort_rows(_read_csv(filename, delimiter, skiprows, dtype))
+            if use_cache:
+                _save_cache(filename, delimiter, skiprows, rows)
         else:
-            # manually unpack for numpy 1.5 compatibility
-            temp = S.loadtxt(filename, 
-                             delimiter=delimiter, 
-                             skiprows=skiprows,
-                             unpack=False,
-                             dtype=[ ('trail',S.int32),
-                                     ('person',S.int32),
-                                     ('eye','S1'), #string of len 1
-                                     ('t',S.float32),
-                                     ('x',S.float32),
-                                     ('y',S.float32)])
-            trial, person, eye, t, x, y = (temp[n] for n in temp.dtype.names)
-            img_filename = None
-            log.info('Found %i entires', trial.size)
+            log.info('Using cached rows')
+        trial, person, eye = rows['trial'], rows['person'], rows['eye']
+        samples = rows['samples']
+        log.info('Found %i entires', trial.size)
             
-        for trial_id in S.unique(trial):
+        for trial_id in np.unique(trial):
             self.trials[trial_id] = {}
-            for person_id in S.unique(person):
+            for person_id in np.unique(person):
                 self.trials[trial_id][person_id] = {}
-                idx = (trial == trial_id) & (person == person_id)
-                #idx_all_trials = (person == person_id)
                 for eye_id in ('L','R','X'):
-                    idx2 = idx & (eye == eye_id)
-                    #idx2_all_trials = idx_all_trials & (eye == eye_id)
-                    self.trials[trial_id][person_id][eye_id] = S.vstack((t[idx2], x[idx2], y[idx2])).T
-                    # special handling for trail_id == 'all'
-                    #self.trials['all'][person_id][eye_id] = S.vstack((t[idx2_all_trials], x[idx2_all_trials], y[idx2_all_trials])).T
-                if img_filename is not None and len(img_filename[idx]) > 0: 
-                    self.trials[trial_id][person_id]['img_filename'] = img_filename[idx][0]
+                    self.trials[trial_id][person_id][eye_id] = np.empty((0,3), dtype=np.float32)
+        
+        # The rows are sorted by (trial, person, eye), so each group is a range
+        # of rows that ends where the key changes. Each trial/person/eye array
+        # is a view of its range, nothing is copied per group. A file with
+        # only a header has no rows and hence no groups.
+        if trial.size > 0:
+            new_tp = (trial[1:] != trial[:-1]) | (person[1:] != person[:-1])
+            starts = np.r_[0, np.flatnonzero(new_tp | (eye[1:] != eye[:-1])) + 1]
+            stops  = np.r_[starts[1:], trial.size]
+            for i0, i1 in zip(starts, stops):
+                if eye[i0] in ('L','R','X'):
+                    self.trials[trial[i0]][person[i0]][eye[i0]] = samples[i0:i1]
+            if image_dir is not None:
+                starts = np.r_[0, np.flatnonzero(new_tp) + 1]
+                for i0, img_filename in zip(starts, rows['img_filename']):
+                    self.trials[trial[i0]][person[i0]]['img_filename'] = img_filename
                 
         if ranges is None:
-            self.ranges = [[x.min(), x.max()]
-                          ,[y.min(), y.max()]]
+            self.ranges = [[samples[:,X].min(), samples[:,X].max()]
+                          ,[samples[:,Y].min(), samples[:,Y].max()]]
         else:
             assert len(ranges) == 2 and len(ranges[0]) == 2
             self.ranges = ranges
@@ -133,7 +274,18 @@ class FixationDataFromCSV(FixationData):
 
 
 class EyeTrackerDataSource(DS.DataSource):
-    '''A data source for the trial of a single person for one eye.'''
+    '''A data source for the trial of a single person for one eye.
+    
+    Each call of _samples is a single slice of the trial's data, so drawing
+    many samples at once with samples(n) is much cheaper than calling
+    sample() in a loop.
+    
+    The drawn samples are copies, because nodes like ShiftEyeTrackingData
+    modify their input in place. Set copy_on_read to False to get views on
+    the fixation data instead, if nothing downstream writes to the samples.
+    '''
+    copy_on_read = True
+    
     def __init__(self, fixation_data=None, trial_id=0, person_id=0, eye=None, ranges=None, **kws):
         self.data   = fixation_data
         self.ranges = ranges if ranges is not None else fixation_data.ranges
@@ -148,11 +300,12 @@ class EyeTrackerDataSource(DS.DataSource):
             dL = self.data.query(trial_id=trial_id,person_id=person_id,eye='L')
             dR = self.data.query(trial_id=trial_id,person_id=person_id,eye='R')
             if len(dL) > len(dR):
-                self.eye = 'L'
+                self.eye, d = 'L', dL
             else:
-                self.eye = 'R'
-        d = self.data.query(trial_id=trial_id,person_id=person_id,eye=self.eye)
-        assert d.ndim == 2, d
+                self.eye, d = 'R', dR
+        else:
+            d = self.data.query(trial_id=trial_id,person_id=person_id,eye=eye)
+        self._d = d # the samples of this source, sliced by _samples
         self.t_begin = d[0,self.T]
         self.t_end   = d[-1,self.T]
         super(EyeTrackerDataSource, self).__init__(number_of_samples_max=len(d), 
@@ -165,11 +318,13 @@ class EyeTrackerDataSource(DS.DataSource):
         
         
     def _samples(self, n=1):
-        s = self.data.query(trial_id=self.trial_id, 
-                            person_id=self.person_id, 
-                            eye=self.eye)[self._t:self._t+n]
+        s = self._d[self._t:self._t+n]
         self._t += n 
-        return s.copy()
+        if not self.copy_on_read:
+            return s
+        # keep the column-major layout of the stored data, so that nodes
+        # working on single columns (e.g. corruptdata) read contiguous memory
+        return s.copy(order='F')
     
     
     def get_imagepath(self):
@@ -223,11 +378,11 @@ class FixationDataFromCSVwithGroundTruth(FixationDataFromCSV):
         for tid in all_trial_ids:
             for pid in sorted(self.trials[tid].keys()):
                 # get the true locations 
-                gt = S.array(self.query(tid, person_id=pid, eye='X'))
+                gt = np.array(self.query(tid, person_id=pid, eye='X'))
                 for eye_id in ('L','R'):
-                    tmp = S.array(self.query(tid, person_id=pid, eye=eye_id))
+                    tmp = np.array(self.query(tid, person_id=pid, eye=eye_id))
                     if len(tmp) > 0:
-                        t_max = S.argmax(tmp[:,0])
+                        t_max = np.argmax(tmp[:,0])
                         
                         # take only the last fixation in this trial=tid
                         # and set the time to the time of the gt
@@ -238,7 +393,7 @@ class FixationDataFromCSVwithGroundTruth(FixationDataFromCSV):
                         new_trials[0][pid]['X'].append( [gt[0][0]+lt, gt[0][1], gt[0][2]] )
         for pid in new_trials[0].keys():
             for eye_id in new_trials[0][pid].keys():
-                new_trials[0][pid][eye_id] = S.array(new_trials[0][pid][eye_id]) 
+                new_trials[0][pid][eye_id] = np.array(new_trials[0][pid][eye_id]) 
         self._old_trials = self.trials
         self.trials = new_trials 
         # for each trial (of the 200) find the last fixation
@@ -250,8 +405,7 @@ if __name__ == '__main__':
     d = FixationDataFromCSV(filename="fixation_data_pbp.csv", image_dir='pbp_imgs')
     #print(d.trials)
     DS = EyeTrackerDataSource(fixation_data=d, trial_id=7, person_id=5, eye=None)
-    for i in range(6):
-        print DS.sample()
+    print DS.samples(6)
     print(repr(DS))
 
 
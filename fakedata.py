@@ -23,7 +23,7 @@ Fake data to simulate and evaluate eye tracking correction.
 __version__ = 1.0
 
 import datasource as DS
-import scipy as S
+import numpy as np
 
 
 class EyeTrackerFakeDataSource(DS.SeededDataSource):
@@ -35,6 +35,9 @@ class EyeTrackerFakeDataSource(DS.SeededDataSource):
     Optionally the Gaussians can have a covariance that makes them elongated
     or rotated.
     '''
+    # number of candidates _sample draws per try for a fixation inside ranges
+    _candidates = 16
+    
     def __init__(self, locs=[], sigmas=[], base_probabilities=[], covariances=[],
                  dt=200, sigma_dt=50, ranges=None, uniform_random_fixations_probability=0.1, **kws):
         '''
@@ -50,7 +53,7 @@ class EyeTrackerFakeDataSource(DS.SeededDataSource):
         @param covariances: 
             Optional. If the Gaussians blobs should not be symmetric, you
             can assign a list of covariance matrices.
-            See scipy.random.multivariate_normal.
+            See numpy.random.multivariate_normal.
         @param dt: 
             The delta t in milliseconds from one fixation to the next. 
             Default to 200.
@@ -63,7 +66,7 @@ class EyeTrackerFakeDataSource(DS.SeededDataSource):
             the actual data range of the locations plus 4*sigma.
         '''
         n = len(locs)
-        self.locs = S.array(locs)
+        self.locs = np.array(locs)
         if sigmas == [] or sigmas is None:
             self.sigmas = [1] * n
         else:
@@ -71,17 +74,27 @@ class EyeTrackerFakeDataSource(DS.SeededDataSource):
             self.sigmas = sigmas
         
         if base_probabilities == [] or base_probabilities is None:
-            self._cs = S.arange(n)+1
+            self._cs = np.arange(n)+1
         else:
             assert len(base_probabilities) == n
-            self._cs = S.cumsum(base_probabilities)
+            self._cs = np.cumsum(base_probabilities)
         
         if covariances == [] or covariances is None:
             # Defaults to circular blog: identity matrix
-            self.covariances = [S.array( [[1,0],[0,1]] ) ] * n
+            self.covariances = [np.array( [[1,0],[0,1]] ) ] * n
         else:
             assert len(covariances) == n
-            self.covariances = S.array(covariances)
+            self.covariances = np.array(covariances)
+        
+        # Factors A with A'A = sigma**2 * covariance, so a fixation of blob i
+        # is locs[i] + z.A with z ~ N(0,I). This is what multivariate_normal
+        # computes (with the same numpy.linalg.svd), but without decomposing
+        # the covariance on every draw.
+        self._factors = []
+        for sigma, cov in zip(self.sigmas, self.covariances):
+            u, s, vh = np.linalg.svd(sigma**2 * np.asarray(cov, dtype=float))
+            self._factors.append(np.sqrt(s)[:,None] * vh)
+        self._factors = np.array(self._factors)
         
         if ranges is None:
             margin = max(self.sigmas) * 4
@@ -108,7 +121,7 @@ class EyeTrackerFakeDataSource(DS.SeededDataSource):
     def _sample(self):
         xr = self.ranges[0]
         yr = self.ranges[1]
-        dt = S.absolute(self.random.normal(loc=self.dt, scale=self.sigma_dt))
+        dt = np.absolute(self.random.normal(loc=self.dt, scale=self.sigma_dt))
         t = self._next_t
         self._next_t += dt
         # First check if we create a new uniform random fixation
@@ -118,16 +131,53 @@ class EyeTrackerFakeDataSource(DS.SeededDataSource):
             return [t, x, y] # return [ [T,X,Y] ]
         # choose the right Gaussian by using the base_probabilities:
         r  = self.random.uniform(low=0.0, high=self._cs[-1])
-        for i in range(len(self.locs)):
-            if self._cs[i] > r: break
-        # And now we draw from the i-th Gaussian
+        i  = int(np.searchsorted(self._cs, r, side='right'))
+        # And now we draw from the i-th Gaussian: several candidates at once,
+        # keeping the first one that lies inside the ranges
         while True:
-            x,y = self.random.multivariate_normal( mean=self.locs[i],
-                                                   cov=self.sigmas[i]**2 * self.covariances[i])
-            if not(xr[0] < x < xr[1]): continue
-            if not(yr[0] < y < yr[1]): continue
-            break
+            xy = self.locs[i] + np.dot(self.random.standard_normal((self._candidates, 2)), 
+                                       self._factors[i])
+            inside = np.flatnonzero((xr[0] < xy[:,0]) & (xy[:,0] < xr[1]) & 
+                                    (yr[0] < xy[:,1]) & (xy[:,1] < yr[1]))
+            if inside.size > 0:
+                x,y = xy[inside[0]]
+                break
         return [t, x, y] # return [ [T,X,Y] ]
+    
+    
+    def _samples(self, n=1):
+        '''Draw n fixations at once. The fixations follow the same
+        distribution as n calls of _sample, but every random quantity is drawn
+        for the whole batch with a single call.'''
+        xr = self.ranges[0]
+        yr = self.ranges[1]
+        # float32, like the fixations loaded by FixationDataFromCSV
+        out = np.empty((n, 3), dtype=np.float32)
+        dts = np.absolute(self.random.normal(loc=self.dt, scale=self.sigma_dt, size=n))
+        out[:,0] = self._next_t
+        out[1:,0] += np.cumsum(dts)[:-1]
+        self._next_t += dts.sum()
+        # uniform random fixations
+        uniform = self.random.uniform(size=n) < self.uniform_random_fixations_probability
+        m = uniform.sum()
+        out[uniform,1] = self.random.uniform(low=xr[0], high=xr[1], size=m)
+        out[uniform,2] = self.random.uniform(low=yr[0], high=yr[1], size=m)
+        # the others are drawn from the Gaussians chosen by base_probabilities,
+        # in a single draw, each scaled by the factor of its blob; fixations
+        # outside of the ranges are redrawn until all of them are inside
+        idx = np.flatnonzero(~uniform)
+        if idx.size > 0:
+            blobs = np.searchsorted(self._cs, 
+                                    self.random.uniform(low=0.0, high=self._cs[-1], size=idx.size),
+                                    side='right')
+        while idx.size > 0:
+            z = self.random.standard_normal((idx.size, 2))
+            xy = self.locs[blobs] + np.einsum('ni,nij->nj', z, self._factors[blobs])
+            out[idx,1:] = xy
+            inside = (xr[0] < xy[:,0]) & (xy[:,0] < xr[1]) & (yr[0] < xy[:,1]) & (xy[:,1] < yr[1])
+            idx = idx[~inside]
+            blobs = blobs[~inside]
+        return out
 
     def __str__(self):
         locs = ', '.join( [ "("+format(x,".0f") +','+ format(y,".0f")+")" for x,y in self.locs] )